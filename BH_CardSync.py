@@ -10,17 +10,33 @@ from datetime import datetime
 import sys
 import argparse
 import queue
+import glob
+import struct
+import zlib
 
 # Очередь для задач UI, чтобы интерфейс не висел, как говно в проруби.
 ui_queue = queue.Queue()
 
-SERVER_ADDRESS = ('ip', port)
+SERVER_ADDRESS = ('ip', 1337)
+CLIENT_VERSION = "0.6.26"
+DELTA_MAGIC = b'KKCSDLT1'
 
 if hasattr(sys, 'frozen') and hasattr(sys, '_MEIPASS'):
     script_dir = os.path.dirname(sys.executable)
 else:
     script_dir = os.path.dirname(os.path.abspath(__file__))
 SETTINGS_FILE = os.path.join(script_dir, 'settings.json')
+SYNC_QUEUE_FILE = os.path.join(script_dir, 'sync_queue.json')
+
+# Файлы от этого размера синхронизируются фоном, чтобы не задерживать карточки.
+LARGE_FILE_THRESHOLD = 50 * 1024 * 1024
+# Правила приоритета: меньше - раньше. Неизвестные расширения идут между картинками и архивами.
+SYNC_PRIORITY_RULES = {
+    'folder': {'cards': 0, 'mods': 1},
+    'direction': {'download': 0, 'upload': 1},
+    'extension': {'.png': 0, '.zipmod': 2, '.zip': 2},
+    'default_extension': 1,
+}
 
 
 SYNC_COLORS = {
@@ -33,7 +49,8 @@ SYNC_COLORS = {
 ICONS = {
     'app': '🔥', 'update': '🔄', 'settings': '⚙️', 'help': '❔', 'disk': '💻',
     'server': '☁️', 'upload': '🔼', 'download': '🔽', 'upload_all': '⏫',
-    'download_all': '⏬', 'sync': '✨', 'cards': '🃏', 'mods': '🧩'
+    'download_all': '⏬', 'sync': '✨', 'cards': '🃏', 'mods': '🧩',
+    'background': '📦', 'cancel': '⏹️'
 }
 
 # --- ОСНОВНЫЕ ФУНКЦИИ ---
@@ -54,9 +71,34 @@ def save_settings(card_folder, mod_folder):
 CARD_FOLDER, MOD_FOLDER = load_settings()
 action_buttons = []
 
+# Сколько передач идёт на переднем плане; пока они есть, кнопки обратно не включаются.
+foreground_transfers = 0
+foreground_lock = threading.Lock()
+
+def _begin_foreground_transfer():
+    global foreground_transfers
+    with foreground_lock:
+        foreground_transfers += 1
+    set_buttons_state(tk.DISABLED)
+
+def _end_foreground_transfer():
+    global foreground_transfers
+    with foreground_lock:
+        foreground_transfers -= 1
+
+def _foreground_transfer_running():
+    with foreground_lock:
+        return foreground_transfers > 0
+
 def set_buttons_state(new_state):
+    def apply_state(button, state):
+        # Например, обновление списков после фоновой задачи не должно включать кнопки посреди синхронизации.
+        if state == tk.NORMAL and _foreground_transfer_running():
+            return
+        button.config(state=state)
+
     for btn in action_buttons:
-        ui_queue.put(lambda b=btn, s=new_state: b.config(state=s))
+        ui_queue.put(lambda b=btn, s=new_state: apply_state(b, s))
 
 def show_color_legend():
     # Код этой функции не изменился, он идеален
@@ -92,6 +134,13 @@ def _hash_file_in_chunks(filepath):
     except IOError:
         return None
 
+def _hash_file_sha256(filepath):
+    sha256_hash = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
 def create_connection():
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -134,6 +183,129 @@ def _recv_json_message(sock):
             except json.JSONDecodeError:
                 continue
 
+def _version_key(version):
+    return tuple(int(part) for part in version.split('.'))
+
+def _download_update_file(sock, step, dest_path):
+    """Качает файл обновления, считая SHA-256 прямо по ходу приёма."""
+    sock.sendall(json.dumps({'command': 'get_update_file', 'file': step['file']}).encode())
+    file_size = int(_recv_line(sock))
+    if file_size != step['size']:
+        raise ValueError(f"Неверный размер '{step['file']}': {file_size} вместо {step['size']}")
+
+    sha256_hash = hashlib.sha256()
+    with open(dest_path, 'wb') as f:
+        received = 0
+        while received < file_size:
+            chunk = sock.recv(min(65536, file_size - received))
+            if not chunk:
+                raise ConnectionError("Соединение разорвано")
+            sha256_hash.update(chunk)
+            f.write(chunk)
+            received += len(chunk)
+
+    if sha256_hash.hexdigest() != step['hash']:
+        raise ValueError(f"Хеш '{step['file']}' не совпал, файл повреждён")
+
+def _apply_delta(old_path, patch_path, new_path):
+    """Собирает новую версию из старой и патча (формат - make_delta на сервере)."""
+    with open(patch_path, 'rb') as f:
+        patch = f.read()
+    if not patch.startswith(DELTA_MAGIC):
+        raise ValueError("Неизвестный формат патча")
+    ops = zlib.decompress(patch[len(DELTA_MAGIC):])
+
+    sha256_hash = hashlib.sha256()
+    with open(old_path, 'rb') as old_file, open(new_path, 'wb') as new_file:
+        position = 0
+        while position < len(ops):
+            op = ops[position:position + 1]
+            if op == b'C':
+                offset, length = struct.unpack_from('<QI', ops, position + 1)
+                position += 13
+                old_file.seek(offset)
+                data = old_file.read(length)
+                if len(data) != length:
+                    raise ValueError("Патч не подходит к текущей версии")
+            elif op == b'L':
+                length, = struct.unpack_from('<I', ops, position + 1)
+                data = ops[position + 5:position + 5 + length]
+                position += 5 + length
+            else:
+                raise ValueError("Повреждённый патч")
+            sha256_hash.update(data)
+            new_file.write(data)
+    return sha256_hash.hexdigest()
+
+def _download_update_route(sock, route, base_path, temp_files):
+    """Проходит маршрут обновления и возвращает путь к собранному exe."""
+    current_path = base_path
+    for step in route:
+        step_path = os.path.join(script_dir, f"{step['file']}.{int(time.time())}.tmp")
+        temp_files.append(step_path)
+        _download_update_file(sock, step, step_path)
+        if step['kind'] == 'patch':
+            built_path = os.path.join(script_dir, f"BH_CardSync_v{step['to']}.exe.{int(time.time())}.tmp")
+            temp_files.append(built_path)
+            if _apply_delta(current_path, step_path, built_path) != step['target_hash']:
+                raise ValueError(f"Версия {step['to']} собрана с ошибкой")
+            current_path = built_path
+        else:
+            current_path = step_path
+    return current_path
+
+def _check_update_thread():
+    """Фоновая проверка обновления: патчи или полный exe, с проверкой хеша каждого шага."""
+    sock = create_connection()
+    if not sock:
+        return
+
+    # Патчить можно только собранный exe; из исходников качаем полную версию.
+    is_frozen = hasattr(sys, 'frozen')
+    temp_files = []
+    try:
+        sock.sendall(json.dumps({'command': 'get_update_manifest', 'version': CLIENT_VERSION if is_frozen else None}).encode())
+        manifest = _recv_json_message(sock)
+        if 'error' in manifest or _version_key(manifest['version']) <= _version_key(CLIENT_VERSION):
+            return
+
+        target_path = os.path.join(script_dir, f"BH_CardSync_v{manifest['version']}.exe")
+        if not (os.path.exists(target_path) and _hash_file_sha256(target_path) == manifest['hash']):
+            ui_queue.put(lambda: status_label.config(text=f"Скачивание обновления v{manifest['version']}..."))
+            full_step = {'kind': 'full', 'to': manifest['version'], 'file': manifest['file'],
+                         'hash': manifest['hash'], 'size': manifest['size'], 'target_hash': manifest['hash']}
+            route = manifest['route']
+            # Патчи строятся от официальной сборки; если наш exe другой, цепочка заведомо не сойдётся.
+            if route and route[0]['kind'] == 'patch' and _hash_file_sha256(sys.executable) != route[0].get('source_hash'):
+                route = [full_step]
+            try:
+                current_path = _download_update_route(sock, route, sys.executable if is_frozen else None, temp_files)
+            except (ValueError, zlib.error) as error:
+                if not any(step['kind'] == 'patch' for step in route):
+                    raise
+                # Патч не подошёл - качаем полный exe по новому соединению, старое могло остаться посреди файла.
+                ui_queue.put(lambda err=error: status_label.config(text=f"Патч не подошёл ({err}), скачиваю полную версию..."))
+                sock.close()
+                sock = create_connection()
+                if not sock:
+                    return
+                current_path = _download_update_route(sock, [full_step], None, temp_files)
+
+            if _hash_file_sha256(current_path) != manifest['hash']:
+                raise ValueError("Хеш обновления не совпал с манифестом")
+            os.replace(current_path, target_path)
+
+        ui_queue.put(lambda: status_label.config(text=f"Обновление v{manifest['version']} готово."))
+        ui_queue.put(lambda: messagebox.showinfo("Обновление", f"Скачана новая версия {manifest['version']}:\n{target_path}\n\nЗакройте программу и запустите новую."))
+    except (ValueError, KeyError, ConnectionError, OSError, zlib.error) as error:
+        ui_queue.put(lambda err=error: status_label.config(text=f"Ошибка обновления: {err}"))
+    finally:
+        if sock:
+            sock.close()
+        for temp_path in temp_files:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
 def update_file_lists():
     if not CARD_FOLDER or not MOD_FOLDER:
         messagebox.showerror("Ошибка", "Пути к папкам не настроены. Укажите их в настройках.")
@@ -159,6 +331,7 @@ def _update_file_lists_thread():
         if 'error' in server_mods:
             raise Exception(server_mods['error'])
         local_mods = _get_local_file_data(MOD_FOLDER)
+        _resume_restored_jobs({'cards': (local_cards, server_cards), 'mods': (local_mods, server_mods)})
 
         ui_queue.put(lambda: _populate_treeview(local_card_treeview, local_cards))
         ui_queue.put(lambda: _populate_treeview(server_card_treeview, server_cards))
@@ -182,7 +355,8 @@ def _get_local_file_data(folder_path):
         return {}
     for filename in os.listdir(folder_path):
         file_path = os.path.join(folder_path, filename)
-        if os.path.isfile(file_path):
+        # *.tmp - недокачанные файлы, иначе умная синхронизация выгрузит их на сервер.
+        if os.path.isfile(file_path) and not filename.endswith('.tmp'):
             file_hash = _hash_file_in_chunks(file_path)
             if file_hash:
                 local_files[filename] = {
@@ -199,45 +373,116 @@ def _populate_treeview(treeview, files_data):
         size_mb = round(data['size'] / (1024 * 1024), 2)
         treeview.insert("", tk.END, values=(filename, size_mb, modified_time_str, data['hash'], data['size'], data['mtime']), iid=filename)
 
+def _compute_sync_status(local_items, server_items):
+    """Сравнивает локальные и серверные файлы, возвращает {имя: тег} для несинхронизированных."""
+    statuses = {}
+    for filename in set(local_items.keys()) | set(server_items.keys()):
+        local_data = local_items.get(filename)
+        server_data = server_items.get(filename)
+        if local_data and not server_data:
+            statuses[filename] = 'local_only'
+        elif server_data and not local_data:
+            statuses[filename] = 'server_only'
+        elif local_data['hash'] != server_data['hash']:
+            statuses[filename] = 'local_newer' if float(local_data['mtime']) > float(server_data['mtime']) else 'server_newer'
+    return statuses
+
+def _plan_smart_sync(local_items, server_items):
+    """Возвращает (что скачать, что выгрузить) для умной синхронизации."""
+    statuses = _compute_sync_status(local_items, server_items)
+    files_to_download = [{'name': filename, 'size': int(server_items[filename]['size']), 'mtime': float(server_items[filename]['mtime'])}
+                         for filename in sorted(server_items) if statuses.get(filename) in ('server_newer', 'server_only')]
+    files_to_upload = [filename for filename in sorted(local_items) if statuses.get(filename) in ('local_newer', 'local_only')]
+    return files_to_download, files_to_upload
+
+def _treeview_items(treeview):
+    items = {}
+    for iid in treeview.get_children():
+        values = treeview.item(iid)['values']
+        items[iid] = {'hash': values[3], 'size': int(values[4]), 'mtime': float(values[5])}
+    return items
+
 def highlight_files_sync_status(local_tree, server_tree):
+    local_items = _treeview_items(local_tree)
+    server_items = _treeview_items(server_tree)
+    statuses = _compute_sync_status(local_items, server_items)
 
-    local_items = {local_tree.item(iid)['values'][0]: {'hash': local_tree.item(iid)['values'][3], 'mtime': float(local_tree.item(iid)['values'][5])} for iid in local_tree.get_children()}
-    server_items = {server_tree.item(iid)['values'][0]: {'hash': server_tree.item(iid)['values'][3], 'mtime': float(server_tree.item(iid)['values'][5])} for iid in server_tree.get_children()}
-    
-    all_filenames = set(local_items.keys()) | set(server_items.keys())
-
-    for filename in all_filenames:
-        local_id = filename if filename in local_items else None
-        server_id = filename if filename in server_items else None
-
-        if local_id:
-            local_tree.item(local_id, tags=())
-        if server_id:
-            server_tree.item(server_id, tags=())
-
-        tag = None
-        if local_id and not server_id:
-            tag = 'local_only'
-        elif not local_id and server_id:
-            tag = 'server_only'
-        elif local_id and server_id:
-            local_hash = local_items[filename]['hash']
-            server_hash = server_items[filename]['hash']
-            if local_hash != server_hash:
-                local_mtime = local_items[filename]['mtime']
-                server_mtime = server_items[filename]['mtime']
-                tag = 'local_newer' if local_mtime > server_mtime else 'server_newer'
-        
-        if tag:
-            if local_id:
-                local_tree.item(local_id, tags=(tag,))
-            if server_id:
-                server_tree.item(server_id, tags=(tag,))
+    for filename in local_items:
+        local_tree.item(filename, tags=(statuses[filename],) if filename in statuses else ())
+    for filename in server_items:
+        server_tree.item(filename, tags=(statuses[filename],) if filename in statuses else ())
+
+class SyncCancelled(Exception):
+    pass
+
+def _download_file(sock, folder_type, file_data, on_chunk=None, cancel_event=None):
+    """Качает один файл по открытому соединению. Возвращает False, если файла нет на сервере."""
+    local_folder = CARD_FOLDER if folder_type == "cards" else MOD_FOLDER
+    filename = file_data['name']
+    sock.sendall(json.dumps({'command': 'get_file', 'filename': filename, 'folder': folder_type}).encode())
+
+    file_size = int(_recv_line(sock))
+    if file_size == 0:
+        return False
+
+    temp_path = os.path.join(local_folder, f"{filename}.{int(time.time())}.tmp")
+    final_path = os.path.join(local_folder, filename)
+    if not os.path.exists(local_folder):
+        os.makedirs(local_folder, exist_ok=True)
+
+    try:
+        with open(temp_path, 'wb') as f:
+            received = 0
+            while received < file_size:
+                if cancel_event and cancel_event.is_set():
+                    raise SyncCancelled()
+                chunk = sock.recv(min(8192, file_size - received))
+                if not chunk:
+                    raise ConnectionError("Соединение разорвано")
+                f.write(chunk)
+                received += len(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+
+        os.utime(temp_path, (time.time(), file_data['mtime']))
+        os.replace(temp_path, final_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+def _upload_file(sock, folder_type, filename, on_chunk=None, cancel_event=None):
+    """Выгружает один файл по открытому соединению. Возвращает False, если файла уже нет на диске."""
+    local_folder = CARD_FOLDER if folder_type == "cards" else MOD_FOLDER
+    file_path = os.path.join(local_folder, filename)
+    if not os.path.isfile(file_path):
+        return False
+
+    sock.sendall(json.dumps({
+        'command': 'upload_file', 'filename': filename, 'size': os.path.getsize(file_path),
+        'folder': folder_type, 'mtime': os.path.getmtime(file_path)
+    }).encode())
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8192), b""):
+            if cancel_event and cancel_event.is_set():
+                raise SyncCancelled()
+            sock.sendall(chunk)
+            if on_chunk:
+                on_chunk(len(chunk))
+    return True
+
+def _run_sync_job(sock, job, on_chunk=None, cancel_event=None):
+    if job['direction'] == 'download':
+        return _download_file(sock, job['folder'], job, on_chunk, cancel_event)
+    return _upload_file(sock, job['folder'], job['name'], on_chunk, cancel_event)
 
 def download_thread(folder_type, files_to_download, callback=None):
-    set_buttons_state(tk.DISABLED)
+    _begin_foreground_transfer()
     sock = create_connection()
     if not sock:
+        _end_foreground_transfer()
         if callback:
             ui_queue.put(callback)
         else:
@@ -245,52 +490,27 @@ def download_thread(folder_type, files_to_download, callback=None):
         return
         
     try:
-        local_folder = CARD_FOLDER if folder_type == "cards" else MOD_FOLDER
         total_size = sum(f['size'] for f in files_to_download)
         bytes_done = 0
         ui_queue.put(lambda: progress_bar.config(maximum=total_size, value=0))
 
+        def on_chunk(size):
+            nonlocal bytes_done
+            bytes_done += size
+            ui_queue.put(lambda v=bytes_done: progress_bar.config(value=v))
+
         for file_data in files_to_download:
             filename = file_data['name']
-            server_mtime = file_data['mtime']
-            temp_path = ""
             try:
-                sock.sendall(json.dumps({'command': 'get_file', 'filename': filename, 'folder': folder_type}).encode())
-                
-                size_str = _recv_line(sock)
-                file_size = int(size_str)
-                if file_size == 0:
+                if not _download_file(sock, folder_type, file_data, on_chunk):
                     ui_queue.put(lambda fn=filename: status_label.config(text=f"Файл '{fn}' не найден на сервере."))
-                    continue
-                
-                temp_path = os.path.join(local_folder, f"{filename}.{int(time.time())}.tmp")
-                final_path = os.path.join(local_folder, filename)
-                
-                if not os.path.exists(local_folder):
-                    os.makedirs(local_folder, exist_ok=True)
-                
-                with open(temp_path, 'wb') as f:
-                    received = 0
-                    while received < file_size:
-                        chunk = sock.recv(min(8192, file_size - received))
-                        if not chunk:
-                            raise ConnectionError("Соединение разорвано")
-                        f.write(chunk)
-                        received += len(chunk)
-                        bytes_done += len(chunk)
-                        ui_queue.put(lambda v=bytes_done: progress_bar.config(value=v))
-
-                os.utime(temp_path, (time.time(), server_mtime))
-                os.replace(temp_path, final_path)
-
             except (ValueError, ConnectionError) as e:
                 ui_queue.put(lambda fn=filename, err=e: messagebox.showerror("Ошибка загрузки", f"Не удалось загрузить '{fn}': {err}"))
-                if temp_path and os.path.exists(temp_path):
-                    os.remove(temp_path)
                 break
     finally:
         if sock:
             sock.close()
+        _end_foreground_transfer()
         if callback:
             ui_queue.put(callback)
         else:
@@ -298,9 +518,10 @@ def download_thread(folder_type, files_to_download, callback=None):
             update_file_lists()
 
 def upload_thread(folder_type, files_to_upload, callback=None):
-    set_buttons_state(tk.DISABLED)
+    _begin_foreground_transfer()
     sock = create_connection()
     if not sock:
+        _end_foreground_transfer()
         if callback:
             ui_queue.put(callback)
         else:
@@ -313,65 +534,239 @@ def upload_thread(folder_type, files_to_upload, callback=None):
         bytes_done = 0
         ui_queue.put(lambda: progress_bar.config(maximum=total_size, value=0))
 
+        def on_chunk(size):
+            nonlocal bytes_done
+            bytes_done += size
+            ui_queue.put(lambda v=bytes_done: progress_bar.config(value=v))
+
         for filename in files_to_upload:
-            file_path = os.path.join(local_folder, filename)
-            if not os.path.isfile(file_path):
-                continue
-            
             try:
-                file_size = os.path.getsize(file_path)
-                mtime = os.path.getmtime(file_path)
-                
-                sock.sendall(json.dumps({
-                    'command': 'upload_file', 'filename': filename, 'size': file_size, 
-                    'folder': folder_type, 'mtime': mtime
-                }).encode())
-                
-                with open(file_path, 'rb') as f:
-                    for chunk in iter(lambda: f.read(8192), b""):
-                        sock.sendall(chunk)
-                        bytes_done += len(chunk)
-                        ui_queue.put(lambda v=bytes_done: progress_bar.config(value=v))
+                _upload_file(sock, folder_type, filename, on_chunk)
             except Exception as e:
                 ui_queue.put(lambda fn=filename, err=e: messagebox.showerror("Ошибка выгрузки", f"Не удалось выгрузить '{fn}': {err}"))
                 break
     finally:
         if sock:
             sock.close()
+        _end_foreground_transfer()
         if callback:
             ui_queue.put(callback)
         else:
             ui_queue.put(lambda: progress_bar.config(value=0))
             update_file_lists()
 
-def smart_sync_thread(folder_type):
-    ui_queue.put(lambda: status_label.config(text=f"Анализ для синхронизации '{folder_type}'..."))
-    local_tree = local_card_treeview if folder_type == "cards" else local_mod_treeview
-    server_tree = server_card_treeview if folder_type == "cards" else server_mod_treeview
-    
-    files_to_download_data = [{'name': server_tree.item(iid)['values'][0], 'size': int(server_tree.item(iid)['values'][4]), 'mtime': float(server_tree.item(iid)['values'][5])} for iid in server_tree.get_children() if 'server_newer' in server_tree.item(iid, 'tags') or 'server_only' in server_tree.item(iid, 'tags')]
-    files_to_upload_data = [ local_tree.item(iid)['values'][0] for iid in local_tree.get_children() if 'local_newer' in local_tree.item(iid, 'tags') or 'local_only' in local_tree.item(iid, 'tags')]
+# --- ОЧЕРЕДЬ СИНХРОНИЗАЦИИ ---
+
+def _sync_job_priority(job):
+    extension = os.path.splitext(job['name'])[1].lower()
+    return (SYNC_PRIORITY_RULES['folder'].get(job['folder'], len(SYNC_PRIORITY_RULES['folder'])),
+            SYNC_PRIORITY_RULES['direction'][job['direction']],
+            SYNC_PRIORITY_RULES['extension'].get(extension, SYNC_PRIORITY_RULES['default_extension']),
+            job['size'], job['name'])
+
+def _make_sync_jobs(folder_type, local_items, server_items):
+    """Превращает план умной синхронизации в задачи, отсортированные по приоритету."""
+    files_to_download, files_to_upload = _plan_smart_sync(local_items, server_items)
+    jobs = [dict(file_data, folder=folder_type, direction='download') for file_data in files_to_download]
+    jobs += [{'name': filename, 'size': int(local_items[filename]['size']), 'mtime': float(local_items[filename]['mtime']),
+              'folder': folder_type, 'direction': 'upload'} for filename in files_to_upload]
+    return sorted(jobs, key=_sync_job_priority)
+
+def _sync_job_key(job):
+    return (job['folder'], job['direction'], job['name'])
+
+# Крупные задачи: выполняются по одной в фоне, переживают перезапуск через SYNC_QUEUE_FILE.
+background_jobs = []
+background_lock = threading.Lock()
+# У каждого воркера своё событие отмены: отмена гасит текущий воркер, а задачи, добавленные после неё,
+# подхватит новый, даже если старый ещё не успел завершиться.
+background_cancel = threading.Event()
+background_worker_running = False
+
+# Задачи из sync_queue.json прошлого запуска. В очередь попадают только после сверки со свежими списками:
+# за это время файл на сервере мог обновить кто-то другой.
+restored_background_jobs = []
+
+def _load_background_jobs():
+    try:
+        with open(SYNC_QUEUE_FILE, 'r', encoding='utf-8') as file:
+            return json.load(file).get('jobs', [])
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+def _save_background_jobs():
+    with open(SYNC_QUEUE_FILE, 'w', encoding='utf-8') as file:
+        json.dump({'jobs': background_jobs}, file, indent=4, ensure_ascii=False)
+
+def _show_background_status(text=None):
+    if text is None:
+        with background_lock:
+            text = f"{ICONS['background']} В фоне: {len(background_jobs)} файл(ов)" if background_jobs else ""
+    ui_queue.put(lambda: background_label.config(text=text))
+
+def enqueue_background_jobs(jobs, start=True):
+    """Добавляет задачи в фоновую очередь и сразу сохраняет её. start=False - только сохранить, не запуская воркер."""
+    global background_worker_running, background_cancel
+    with background_lock:
+        known = {_sync_job_key(job) for job in background_jobs}
+        background_jobs.extend(job for job in jobs if _sync_job_key(job) not in known)
+        background_jobs.sort(key=_sync_job_priority)
+        _save_background_jobs()
+        start_worker = start and bool(background_jobs) and (not background_worker_running or background_cancel.is_set())
+        if start_worker:
+            background_worker_running = True
+            background_cancel = threading.Event()
+            cancel_event = background_cancel
+    if start_worker:
+        threading.Thread(target=_background_sync_worker, args=(cancel_event,), daemon=True).start()
+    _show_background_status()
+
+def _resume_restored_jobs(file_lists):
+    """Перепланирует восстановленные задачи по {папка: (локальные, серверные)} и ставит в очередь актуальные."""
+    global restored_background_jobs
+    with background_lock:
+        jobs, restored_background_jobs = restored_background_jobs, []
+    if not jobs:
+        return
 
-    if not files_to_download_data and not files_to_upload_data:
-        ui_queue.put(lambda: messagebox.showinfo("Синхронизация", "Все файлы уже синхронизированы!"))
+    restored_keys = {_sync_job_key(job) for job in jobs}
+    fresh_jobs = []
+    for folder_type, (local_items, server_items) in file_lists.items():
+        fresh_jobs += [job for job in _make_sync_jobs(folder_type, local_items, server_items) if _sync_job_key(job) in restored_keys]
+    enqueue_background_jobs(fresh_jobs)
+
+def cancel_background_jobs():
+    with background_lock:
+        background_jobs.clear()
+        _save_background_jobs()
+        background_cancel.set()
+    _show_background_status()
+    ui_queue.put(lambda: status_label.config(text="Фоновая синхронизация отменена."))
+
+def _refresh_after_background():
+    # Передача на переднем плане сама обновит списки, когда закончит.
+    if not _foreground_transfer_running():
+        update_file_lists()
+
+def _wait_for_foreground(cancel_event):
+    # Фон не делит канал с передачами на переднем плане: карточки должны прийти первыми.
+    while _foreground_transfer_running() and not cancel_event.is_set():
+        time.sleep(0.2)
+
+def _background_sync_worker(cancel_event):
+    global background_worker_running
+    sock = None
+    completed = 0
+    try:
+        while True:
+            _wait_for_foreground(cancel_event)
+            with background_lock:
+                if not background_jobs or cancel_event.is_set():
+                    break
+                job, remaining = background_jobs[0], len(background_jobs)
+
+            if sock is None:
+                sock = create_connection()
+                if not sock:
+                    break  # Задачи остались в файле очереди, продолжим при следующем запуске.
+
+            if job['direction'] == 'download':
+                local_folder = CARD_FOLDER if job['folder'] == "cards" else MOD_FOLDER
+                for stale_path in glob.glob(os.path.join(glob.escape(local_folder), glob.escape(job['name']) + '.*.tmp')):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass  # Файл ещё держит отменённый воркер - он удалит его сам.
+
+            bytes_done = 0
+            last_percent = -1
+
+            def on_chunk(size):
+                nonlocal bytes_done, last_percent
+                _wait_for_foreground(cancel_event)
+                bytes_done += size
+                percent = bytes_done * 100 // max(job['size'], 1)
+                if percent != last_percent:
+                    last_percent = percent
+                    _show_background_status(f"{ICONS['background']} {ICONS[job['direction']]} {job['name']}: {percent}% (в очереди: {remaining})")
+
+            try:
+                _run_sync_job(sock, job, on_chunk, cancel_event)
+            except SyncCancelled:
+                break
+            except (ValueError, ConnectionError, OSError) as error:
+                ui_queue.put(lambda fn=job['name'], err=error: status_label.config(text=f"Фоновая синхронизация '{fn}' прервана: {err}"))
+                break
+
+            completed += 1
+            with background_lock:
+                if job in background_jobs:
+                    background_jobs.remove(job)
+                    _save_background_jobs()
+    finally:
+        if sock:
+            sock.close()
+        with background_lock:
+            if background_cancel is cancel_event:
+                background_worker_running = False
+        _show_background_status()
+        if completed:
+            ui_queue.put(_refresh_after_background)
+
+def sync_jobs_thread(jobs):
+    """Выполняет мелкие задачи по порядку приоритета одним соединением."""
+    _begin_foreground_transfer()
+    sock = create_connection()
+    if not sock:
+        _end_foreground_transfer()
+        set_buttons_state(tk.NORMAL)
         return
 
-    def final_update():
+    try:
+        bytes_done = 0
+        ui_queue.put(lambda: progress_bar.config(maximum=sum(job['size'] for job in jobs), value=0))
+
+        def on_chunk(size):
+            nonlocal bytes_done
+            bytes_done += size
+            ui_queue.put(lambda v=bytes_done: progress_bar.config(value=v))
+
+        for index, job in enumerate(jobs, 1):
+            ui_queue.put(lambda j=job, i=index: status_label.config(text=f"{ICONS[j['direction']]} {i}/{len(jobs)}: {j['name']}"))
+            try:
+                _run_sync_job(sock, job, on_chunk)
+            except (ValueError, ConnectionError, OSError) as e:
+                ui_queue.put(lambda fn=job['name'], err=e: messagebox.showerror("Ошибка синхронизации", f"Не удалось синхронизировать '{fn}': {err}"))
+                break
+    finally:
+        sock.close()
+        _end_foreground_transfer()
+        ui_queue.put(lambda: progress_bar.config(value=0))
         ui_queue.put(lambda: status_label.config(text="Синхронизация завершена. Обновляю списки..."))
         update_file_lists()
 
-    def run_uploads():
-        if files_to_upload_data:
-            ui_queue.put(lambda: status_label.config(text=f"Выгрузка {len(files_to_upload_data)} файлов..."))
-            threading.Thread(target=upload_thread, args=(folder_type, files_to_upload_data, final_update), daemon=True).start()
-        else:
-            final_update()
-    
-    if files_to_download_data:
-        ui_queue.put(lambda: status_label.config(text=f"Загрузка {len(files_to_download_data)} файлов..."))
-        threading.Thread(target=download_thread, args=(folder_type, files_to_download_data, run_uploads), daemon=True).start()
+def smart_sync_thread():
+    """Синхронизирует карточки и моды одной очередью, упорядоченной по SYNC_PRIORITY_RULES."""
+    ui_queue.put(lambda: status_label.config(text="Анализ для синхронизации..."))
+    jobs = _make_sync_jobs('cards', _treeview_items(local_card_treeview), _treeview_items(server_card_treeview))
+    jobs += _make_sync_jobs('mods', _treeview_items(local_mod_treeview), _treeview_items(server_mod_treeview))
+    jobs.sort(key=_sync_job_priority)
+    if not jobs:
+        ui_queue.put(lambda: messagebox.showinfo("Синхронизация", "Все файлы уже синхронизированы!"))
+        return
+
+    large_jobs = [job for job in jobs if job['size'] >= LARGE_FILE_THRESHOLD]
+    small_jobs = [job for job in jobs if job['size'] < LARGE_FILE_THRESHOLD]
+    if large_jobs:
+        # Сохраняем сразу, чтобы пережить перезапуск, но качаем только после мелких.
+        enqueue_background_jobs(large_jobs, start=False)
+    if small_jobs:
+        ui_queue.put(lambda: status_label.config(text=f"Синхронизация {len(small_jobs)} файлов..."))
+        sync_jobs_thread(small_jobs)
     else:
-        run_uploads()
+        ui_queue.put(lambda: status_label.config(text=f"Крупные файлы ({len(large_jobs)}) синхронизируются в фоне."))
+    if large_jobs:
+        enqueue_background_jobs([])
 
 def download_selected(folder_type, update_all=False):
     server_tree = server_card_treeview if folder_type == "cards" else server_mod_treeview
@@ -392,9 +787,9 @@ def upload_selected(folder_type, update_all=False):
     files_data = [local_tree.item(iid)['values'][0] for iid in iids]
     threading.Thread(target=upload_thread, args=(folder_type, files_data, None), daemon=True).start()
 
-def start_smart_sync(folder_type):
-    if messagebox.askokcancel("Умная синхронизация", f"Начать умную синхронизацию для '{folder_type}'?"):
-        threading.Thread(target=smart_sync_thread, args=(folder_type,), daemon=True).start()
+def start_smart_sync():
+    if messagebox.askokcancel("Умная синхронизация", "Начать умную синхронизацию карточек и модов?"):
+        threading.Thread(target=smart_sync_thread, daemon=True).start()
 
 def change_folders():
     global CARD_FOLDER, MOD_FOLDER
@@ -454,7 +849,7 @@ def create_sync_tab(parent, title, folder_type):
     download_all_btn = ttk.Button(main_frame, text=f"{ICONS.get('download_all', '')} Загрузить ВСЁ", command=lambda: download_selected(folder_type, update_all=True))
     download_all_btn.grid(row=3, column=1, pady=(5,0), sticky=tk.EW, padx=(5,0))
     
-    sync_btn = ttk.Button(main_frame, text=f"{ICONS.get('sync', '')} УМНАЯ СИНХРОНИЗАЦИЯ", command=lambda: start_smart_sync(folder_type))
+    sync_btn = ttk.Button(main_frame, text=f"{ICONS.get('sync', '')} УМНАЯ СИНХРОНИЗАЦИЯ", command=start_smart_sync)
     sync_btn.grid(row=4, column=0, columnspan=2, pady=(10,0), sticky=tk.EW)
 
     main_frame.columnconfigure(0, weight=1)
@@ -481,6 +876,10 @@ if __name__ == '__main__':
     action_buttons.append(change_folder_button)
     help_button = ttk.Button(top_frame, text=f"{ICONS.get('help', '')} Справка", command=show_color_legend)
     help_button.pack(side=tk.LEFT, padx=(0, 10))
+    cancel_background_button = ttk.Button(top_frame, text=f"{ICONS.get('cancel', '')} Отменить фон", command=cancel_background_jobs)
+    cancel_background_button.pack(side=tk.RIGHT)
+    background_label = ttk.Label(top_frame, text="", anchor=tk.E)
+    background_label.pack(side=tk.RIGHT, padx=(10, 5))
     status_label = ttk.Label(top_frame, text="Готов к работе", anchor=tk.W)
     status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
@@ -497,7 +896,9 @@ if __name__ == '__main__':
             tree.tag_configure(tag, background=color)
 
     if CARD_FOLDER and MOD_FOLDER:
+        restored_background_jobs.extend(_load_background_jobs())
         update_file_lists()
+    threading.Thread(target=_check_update_thread, daemon=True).start()
     
     window.protocol("WM_DELETE_WINDOW", window.destroy)
 
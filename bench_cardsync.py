@@ -0,0 +1,357 @@
+"""Бенчмарк синхронизатора: синтетические карточки/моды, сервер на loopback, клиент без UI.
+
+Пример:
+    python bench_cardsync.py --cards 2000 --card-kb 300 --mods 3 --mod-mb 2048 --clients 4 --output bench.json
+
+Результат - JSON (в stdout или в --output), чтобы прогоны можно было сравнивать между собой.
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, script_dir)
+
+BENCH_FORMAT_VERSION = 1
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+WRITE_CHUNK = 4 * 1024 * 1024
+
+
+def _write_random_file(path, size, header=b'', seed=0):
+    """Пишет файл заданного размера: заголовок + псевдослучайные данные, без загрузки всего в память."""
+    rng = random.Random(seed)
+    with open(path, 'wb') as file:
+        file.write(header[:size])
+        left = size - min(len(header), size)
+        while left > 0:
+            chunk = min(WRITE_CHUNK, left)
+            file.write(rng.randbytes(chunk))
+            left -= chunk
+
+
+def build_corpus(root, cards, card_kb, mods, mod_mb, seed):
+    """Создаёт синтетические папки: сервера (cards/mods) и пустые клиентские."""
+    rng = random.Random(seed)
+    layout = {name: os.path.join(root, name) for name in ('server_cards', 'server_mods', 'client_cards', 'client_mods')}
+    for path in layout.values():
+        os.makedirs(path, exist_ok=True)
+
+    for index in range(cards):
+        size = max(len(PNG_SIGNATURE), int(card_kb * 1024 * rng.uniform(0.5, 1.5)))
+        _write_random_file(os.path.join(layout['server_cards'], f"card_{index:06d}.png"), size, PNG_SIGNATURE, seed + index)
+    for index in range(mods):
+        _write_random_file(os.path.join(layout['server_mods'], f"mod_{index:03d}.zipmod"), mod_mb * 1024 * 1024, b'PK\x03\x04', seed - index - 1)
+    return layout
+
+
+def evict_page_cache(folder):
+    """Выкидывает файлы папки из кеша страниц ОС, чтобы первый проход читал с диска.
+
+    Возвращает False, если ОС этого не умеет (например, Windows) - тогда "холодный" замер на самом деле тёплый.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for filename in os.listdir(folder):
+        file_path = os.path.join(folder, filename)
+        if os.path.isfile(file_path):
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)  # Грязные страницы DONTNEED не выкидывает.
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port, card_folder, mod_folder):
+    """Запускает настоящий сервер из burninghellascardupdaterSRV.py с подменёнными папками."""
+    import logging
+    import burninghellascardupdaterSRV as server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    server.CARD_FOLDER = card_folder
+    server.MOD_FOLDER = mod_folder
+    server.run_server('127.0.0.1', port, serve_updates=False)
+
+
+def start_server(layout):
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port),
+                                layout['server_cards'], layout['server_mods']])
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("Сервер завершился при запуске")
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Сервер не поднялся за 15 секунд")
+
+
+class _DiscardQueue(queue.Queue):
+    def put(self, item, block=True, timeout=None):
+        pass
+
+
+def load_client(port, layout):
+    """Импортирует клиента без окна: только сетевые функции и сканирование."""
+    import BH_CardSync as client
+
+    client.SERVER_ADDRESS = ('127.0.0.1', port)
+    client.CARD_FOLDER = layout['client_cards']
+    client.MOD_FOLDER = layout['client_mods']
+
+    # UI-задачи (прогресс, статус) клиент кладёт в очередь; без окна они не нужны.
+    client.ui_queue = _DiscardQueue()
+    return client
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def bench_list_files(client, folder, server_folder, repeats):
+    def list_once():
+        sock = client.create_connection()
+        try:
+            sock.sendall(json.dumps({'command': 'list_files', 'folder': folder}).encode())
+            return client._recv_json_message(sock)
+        finally:
+            sock.close()
+
+    evicted = evict_page_cache(server_folder)
+    cold, files = _timed(list_once)
+    warm = [_timed(list_once)[0] for _ in range(repeats)]
+    return {'files': len(files), 'page_cache_evicted': evicted, 'cold_s': cold, 'warm_s': warm,
+            'warm_best_s': min(warm) if warm else None}, files
+
+
+def bench_local_scan(client, folder, repeats):
+    evicted = evict_page_cache(folder)
+    cold, files = _timed(client._get_local_file_data, folder)
+    warm = [_timed(client._get_local_file_data, folder)[0] for _ in range(repeats)]
+    return {'files': len(files), 'page_cache_evicted': evicted, 'cold_s': cold, 'warm_s': warm,
+            'warm_best_s': min(warm) if warm else None}
+
+
+def _plan_like_smart_sync(client, file_lists):
+    # То же, что smart_sync_thread: задачи по обеим папкам и общая сортировка по приоритету.
+    jobs = []
+    for folder, (local_files, server_files) in file_lists.items():
+        jobs += client._make_sync_jobs(folder, local_files, server_files)
+    jobs.sort(key=client._sync_job_priority)
+    return jobs
+
+
+def bench_planning(client, server_lists, repeats):
+    """Замеряет планирование умной синхронизации по {папка: серверный список}."""
+    file_lists = {}
+    for folder, server_files in server_lists.items():
+        # Половина файлов "уже есть" локально, четверть из них отличается - типичная картина после обновления.
+        local_files = {}
+        for index, (name, data) in enumerate(sorted(server_files.items())):
+            if index % 2:
+                continue
+            local_files[name] = dict(data)
+            if index % 4 == 0:
+                local_files[name]['hash'] = 'x' + data['hash'][1:]
+                local_files[name]['mtime'] = data['mtime'] + 1
+        file_lists[folder] = (local_files, server_files)
+
+    timings = []
+    for _ in range(max(1, repeats)):
+        elapsed, jobs = _timed(_plan_like_smart_sync, client, file_lists)
+        timings.append(elapsed)
+    return {'server_files': sum(len(server) for _, server in file_lists.values()),
+            'local_files': sum(len(local) for local, _ in file_lists.values()),
+            'downloads': sum(job['direction'] == 'download' for job in jobs),
+            'uploads': sum(job['direction'] == 'upload' for job in jobs),
+            'best_s': min(timings), 'timings_s': timings}
+
+
+def _to_download_list(server_files, names):
+    return [{'name': name, 'size': server_files[name]['size'], 'mtime': server_files[name]['mtime']} for name in names]
+
+
+def bench_transfer(client, folder, server_files, names, target_folder):
+    """Качает файлы штатным download_thread клиента в отдельную папку."""
+    shutil.rmtree(target_folder, ignore_errors=True)
+    os.makedirs(target_folder)
+    files = _to_download_list(server_files, names)
+    total_bytes = sum(f['size'] for f in files)
+    client.CARD_FOLDER = client.MOD_FOLDER = target_folder
+    elapsed, _ = _timed(client.download_thread, folder, files, lambda: None)
+    received = sum(os.path.getsize(os.path.join(target_folder, f['name'])) for f in files
+                   if os.path.exists(os.path.join(target_folder, f['name'])))
+    return {'files': len(files), 'bytes': total_bytes, 'received_bytes': received, 'seconds': elapsed,
+            'mb_per_s': total_bytes / (1024 * 1024) / elapsed if elapsed else None,
+            'files_per_s': len(files) / elapsed if elapsed else None}
+
+
+def bench_small_uploads(client, count, root, server_folder, seed):
+    """Выгружает мелкие файлы подряд по одному соединению и проверяет, что сервер получил каждый.
+
+    Заодно регрессионная проверка разбора команд на сервере: при ошибке кадрирования файлы пропадают молча.
+    """
+    source_folder = os.path.join(root, 'uploads')
+    os.makedirs(source_folder, exist_ok=True)
+    rng = random.Random(seed)
+    names = []
+    for index in range(count):
+        name = f"upload_{index:05d}.png"
+        _write_random_file(os.path.join(source_folder, name), rng.randint(64, 6000), PNG_SIGNATURE, seed + index)
+        names.append(name)
+
+    client.CARD_FOLDER = source_folder
+    sock = client.create_connection()
+
+    def upload_all():
+        for name in names:
+            client._upload_file(sock, 'cards', name)
+
+    try:
+        elapsed, _ = _timed(upload_all)
+    finally:
+        sock.close()
+
+    def lost_files():
+        return [name for name in names if not os.path.exists(os.path.join(server_folder, name))
+                or os.path.getsize(os.path.join(server_folder, name)) != os.path.getsize(os.path.join(source_folder, name))]
+
+    # Сервер дописывает последние файлы уже после того, как клиент всё отправил.
+    deadline = time.time() + 10
+    while lost_files() and time.time() < deadline:
+        time.sleep(0.05)
+    lost = lost_files()
+    return {'files': count, 'seconds': elapsed, 'files_per_s': count / elapsed if elapsed else None,
+            'lost_files': len(lost), 'lost_examples': lost[:10]}
+
+
+def client_worker(port, job_path):
+    """Отдельный процесс-клиент для замера одновременных загрузок."""
+    with open(job_path, encoding='utf-8') as file:
+        job = json.load(file)
+    layout = {'client_cards': job['target'], 'client_mods': job['target']}
+    client = load_client(port, layout)
+    server_files = {f['name']: f for f in job['files']}
+    print(json.dumps(bench_transfer(client, job['folder'], server_files, list(server_files), job['target'])))
+
+
+def bench_concurrent(port, folder, server_files, names, clients, root):
+    files = _to_download_list(server_files, names)
+    processes = []
+    for index in range(clients):
+        job_path = os.path.join(root, f"concurrent_{index}.json")
+        with open(job_path, 'w', encoding='utf-8') as file:
+            json.dump({'folder': folder, 'files': files, 'target': os.path.join(root, f"concurrent_{index}")}, file)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--client', str(port), job_path],
+                                          stdout=subprocess.PIPE, text=True))
+    started = time.perf_counter()
+    results = [json.loads(process.communicate()[0]) for process in processes]
+    elapsed = time.perf_counter() - started
+    total_bytes = sum(r['bytes'] for r in results)
+    return {'clients': clients, 'seconds': elapsed, 'bytes': total_bytes,
+            'aggregate_mb_per_s': total_bytes / (1024 * 1024) / elapsed if elapsed else None,
+            'slowest_client_s': max(r['seconds'] for r in results), 'per_client': results}
+
+
+def run_benchmarks(args):
+    root = args.workdir or tempfile.mkdtemp(prefix='kkcs_bench_')
+    report = {'format': BENCH_FORMAT_VERSION, 'started': datetime.now().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0], 'platform': platform.platform(),
+              'params': {'cards': args.cards, 'card_kb': args.card_kb, 'mods': args.mods, 'mod_mb': args.mod_mb,
+                         'clients': args.clients, 'repeats': args.repeats, 'seed': args.seed,
+                         'small_uploads': args.small_uploads},
+              'results': {}}
+    results = report['results']
+    server_process = None
+    try:
+        corpus_time, layout = _timed(build_corpus, root, args.cards, args.card_kb, args.mods, args.mod_mb, args.seed)
+        results['corpus_build_s'] = corpus_time
+        server_process, port = start_server(layout)
+        client = load_client(port, layout)
+
+        results['list_files_cards'], server_cards = bench_list_files(client, 'cards', layout['server_cards'], args.repeats)
+        results['list_files_mods'], server_mods = bench_list_files(client, 'mods', layout['server_mods'], args.repeats)
+        results['local_scan_cards'] = bench_local_scan(client, layout['server_cards'], args.repeats)
+        results['local_scan_mods'] = bench_local_scan(client, layout['server_mods'], args.repeats)
+        results['smart_sync_planning'] = bench_planning(client, {'cards': server_cards, 'mods': server_mods}, args.repeats)
+
+        if server_mods:
+            largest = max(server_mods, key=lambda name: server_mods[name]['size'])
+            results['single_file'] = bench_transfer(client, 'mods', server_mods, [largest], os.path.join(root, 'single'))
+        small = sorted(server_cards)[:args.small_files]
+        if small:
+            results['many_small_files'] = bench_transfer(client, 'cards', server_cards, small, os.path.join(root, 'small'))
+            if args.clients > 1:
+                results['concurrent_small_files'] = bench_concurrent(port, 'cards', server_cards, small, args.clients, root)
+        if args.small_uploads:
+            # Последним: пишет новые файлы в серверную папку карточек.
+            results['many_small_uploads'] = bench_small_uploads(client, args.small_uploads, root, layout['server_cards'], args.seed)
+    finally:
+        if server_process:
+            server_process.terminate()
+            server_process.wait(timeout=10)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+    report['finished'] = datetime.now().isoformat(timespec='seconds')
+    return report
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--serve':
+        serve(int(sys.argv[2]), sys.argv[3], sys.argv[4])
+        return
+    if len(sys.argv) == 4 and sys.argv[1] == '--client':
+        client_worker(int(sys.argv[2]), sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description="Бенчмарк синхронизатора карточек и модов")
+    parser.add_argument('--cards', type=int, default=2000, help="сколько карточек сгенерировать")
+    parser.add_argument('--card-kb', type=int, default=300, help="средний размер карточки, КБ")
+    parser.add_argument('--mods', type=int, default=2, help="сколько модов сгенерировать")
+    parser.add_argument('--mod-mb', type=int, default=256, help="размер одного мода, МБ (для реальной картины - 2048+)")
+    parser.add_argument('--small-files', type=int, default=500, help="сколько карточек качать в тесте мелких файлов")
+    parser.add_argument('--small-uploads', type=int, default=200, help="сколько мелких файлов выгрузить подряд (0 - не проверять)")
+    parser.add_argument('--clients', type=int, default=4, help="одновременных клиентов")
+    parser.add_argument('--repeats', type=int, default=3, help="повторов для тёплых замеров")
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--workdir', help="папка для корпуса (по умолчанию временная, удаляется)")
+    parser.add_argument('--keep', action='store_true', help="не удалять временную папку")
+    parser.add_argument('--output', help="куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+    else:
+        print(text)
+    if report['results'].get('many_small_uploads', {}).get('lost_files'):
+        sys.exit("Сервер потерял часть выгруженных файлов, см. many_small_uploads.")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,9 @@ import os
 import json
 import logging
 import time
+import re
+import struct
+import zlib
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -15,6 +18,14 @@ MOD_FOLDER = r'C:\\KKS\\mods'
 UPDATE_FOLDER = 'KKCSupdates'
 SERVER_VERSION = "0.6.26"
 BUFFER_SIZE = 4096
+MAX_REQUEST_SIZE = 64 * 1024
+UPDATE_PATCH_FOLDER = os.path.join(UPDATE_FOLDER, 'patches')
+UPDATE_FILE_PATTERN = re.compile(r'^BH_CardSync_v(\d+(?:\.\d+)*)\.exe$')
+DELTA_MAGIC = b'KKCSDLT1'
+DELTA_BLOCK_SIZE = 4096
+
+update_manifest = None
+update_manifest_lock = threading.Lock()
 
 
 def get_file_info(file_path):
@@ -48,15 +59,22 @@ def send_file(connection, file_path):
 
 
 
-def receive_file(connection, file_path, file_size, modified_time):
-    """Получает файл от клиента."""
+def receive_file(connection, file_path, file_size, modified_time, initial_data=b''):
+    """Получает файл от клиента. Пишет во временный файл, чтобы прерванная загрузка не портила старую версию.
+
+    initial_data - байты, пришедшие вместе с командой. Возвращает то, что в них было после файла
+    (начало следующей команды).
+    """
+    temp_path = f"{file_path}.{int(time.time())}.tmp"
     try:
         logging.info(f"Получение файла {file_path} размером {file_size} байт")
-        with open(file_path, 'wb') as file:
-            received_bytes = 0
+        with open(temp_path, 'wb') as file:
+            # Начало файла могло прийти в одном пакете с командой.
+            file.write(initial_data[:file_size])
+            received_bytes = len(initial_data[:file_size])
 
             while received_bytes < file_size:
-                data = connection.recv(BUFFER_SIZE)
+                data = connection.recv(min(BUFFER_SIZE, file_size - received_bytes))
 
                 if not data:
                     logging.error("Ошибка: соединение разорвано.")
@@ -65,28 +83,243 @@ def receive_file(connection, file_path, file_size, modified_time):
                 file.write(data)
                 received_bytes += len(data)
 
-        os.utime(file_path, (modified_time, modified_time))
+        os.utime(temp_path, (modified_time, modified_time))
+        os.replace(temp_path, file_path)
         logging.info(f"Файл {file_path} получен успешно. Время модификации: {modified_time}")
+        return initial_data[file_size:]
 
     except Exception as error:
         logging.error(f"Ошибка при получении файла {file_path}: {error}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         if isinstance(error, ConnectionResetError):
             raise  # Перевыбрасываем исключение, чтобы прервать обработку клиента
+        return b''
+
+
+
+def _version_key(version):
+    return tuple(int(part) for part in version.split('.'))
+
+
+def get_file_sha256(file_path):
+    """Считает SHA-256 файла по кускам, не загружая его целиком в память."""
+    sha256_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def make_delta(old_path, new_path, patch_path):
+    """Строит бинарный патч old -> new: копирование совпавших блоков старого файла + новые данные.
+
+    Формат: DELTA_MAGIC + zlib(операции), операция - b'C' + <смещение, длина> или b'L' + <длина> + данные.
+    """
+    with open(old_path, 'rb') as file:
+        old = file.read()
+    with open(new_path, 'rb') as file:
+        new = file.read()
+    block = DELTA_BLOCK_SIZE
+
+    # Слабый ключ блока: сумма байт + первый и последний байт. Его можно сдвигать на байт за O(1).
+    index = {}
+    for offset in range(0, len(old) - block + 1, block):
+        key = (sum(old[offset:offset + block]), old[offset], old[offset + block - 1])
+        offsets = index.setdefault(key, [])
+        if len(offsets) < 8:
+            offsets.append(offset)
+
+    ops = []
+
+    def flush_literal(start, end):
+        if end > start:
+            ops.append(b'L' + struct.pack('<I', end - start) + new[start:end])
+
+    position = literal_start = 0
+    window_sum = sum(new[0:block]) if len(new) >= block else 0
+    while position + block <= len(new):
+        match = None
+        for offset in index.get((window_sum, new[position], new[position + block - 1]), ()):
+            if old[offset:offset + block] == new[position:position + block]:
+                match = offset
+                break
+
+        if match is None:
+            if position + block < len(new):
+                window_sum += new[position + block] - new[position]
+            position += 1
+            continue
+
+        length = block
+        while (position + length + block <= len(new) and match + length + block <= len(old)
+               and new[position + length:position + length + block] == old[match + length:match + length + block]):
+            length += block
+        flush_literal(literal_start, position)
+        ops.append(b'C' + struct.pack('<QI', match, length))
+        position = literal_start = position + length
+        window_sum = sum(new[position:position + block])
+    flush_literal(literal_start, len(new))
+
+    os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+    temp_path = patch_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(DELTA_MAGIC + zlib.compress(b''.join(ops), 9))
+    os.replace(temp_path, patch_path)
+
+
+def prepare_updates():
+    """Собирает манифест обновлений и готовит патчи между соседними версиями из UPDATE_FOLDER."""
+    global update_manifest
+    try:
+        if not os.path.isdir(UPDATE_FOLDER):
+            logging.warning(f"Папка обновлений {UPDATE_FOLDER} не найдена.")
+            return
+
+        builds = []
+        for filename in os.listdir(UPDATE_FOLDER):
+            match = UPDATE_FILE_PATTERN.match(filename)
+            if match and _version_key(match.group(1)) <= _version_key(SERVER_VERSION):
+                file_path = os.path.join(UPDATE_FOLDER, filename)
+                builds.append({'version': match.group(1), 'file': filename,
+                               'hash': get_file_sha256(file_path), 'size': os.path.getsize(file_path)})
+        builds.sort(key=lambda build: _version_key(build['version']))
+
+        if not builds or builds[-1]['version'] != SERVER_VERSION:
+            logging.error(f"Файл обновления для версии {SERVER_VERSION} не найден в {UPDATE_FOLDER}.")
+            return
+
+        patches = []
+        for old_build, new_build in zip(builds, builds[1:]):
+            # Хеши в имени: если сборку пересобрали под той же версией, старый патч не подхватится.
+            patch_prefix = f"BH_CardSync_v{old_build['version']}_to_v{new_build['version']}_"
+            patch_name = f"{patch_prefix}{old_build['hash'][:16]}_{new_build['hash'][:16]}.kkpatch"
+            patch_path = os.path.join(UPDATE_PATCH_FOLDER, patch_name)
+            if not os.path.exists(patch_path):
+                if os.path.isdir(UPDATE_PATCH_FOLDER):
+                    for stale_name in os.listdir(UPDATE_PATCH_FOLDER):
+                        if stale_name.startswith(patch_prefix):
+                            os.remove(os.path.join(UPDATE_PATCH_FOLDER, stale_name))
+                logging.info(f"Создание патча {patch_name}...")
+                make_delta(os.path.join(UPDATE_FOLDER, old_build['file']), os.path.join(UPDATE_FOLDER, new_build['file']), patch_path)
+            patches.append({'from': old_build['version'], 'to': new_build['version'], 'file': patch_name,
+                            'hash': get_file_sha256(patch_path), 'size': os.path.getsize(patch_path),
+                            'source_hash': old_build['hash'], 'target_hash': new_build['hash']})
+
+        manifest = {'version': SERVER_VERSION, 'file': builds[-1]['file'], 'hash': builds[-1]['hash'],
+                    'size': builds[-1]['size'], 'builds': builds, 'patches': patches}
+        with open(os.path.join(UPDATE_FOLDER, 'manifest.json'), 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=4)
+        with update_manifest_lock:
+            update_manifest = manifest
+        logging.info(f"Манифест обновлений готов: версия {SERVER_VERSION}, сборок {len(builds)}, патчей {len(patches)}")
+    except Exception as error:
+        logging.error(f"Ошибка при подготовке обновлений: {error}")
 
 
+def get_update_route(client_version):
+    """Выбирает самый маленький путь до текущей версии: цепочка патчей или полный exe."""
+    with update_manifest_lock:
+        manifest = update_manifest
+    if not manifest:
+        return None
+
+    route = []
+    if client_version != manifest['version']:
+        full_route = [{'kind': 'full', 'from': client_version, 'to': manifest['version'], 'file': manifest['file'],
+                       'hash': manifest['hash'], 'size': manifest['size'], 'target_hash': manifest['hash']}]
+        patches_by_version = {patch['from']: patch for patch in manifest['patches']}
+        patch_route = []
+        version = client_version
+        while version in patches_by_version:
+            patch_route.append(dict(patches_by_version[version], kind='patch'))
+            version = patches_by_version[version]['to']
+        route = full_route
+        if version == manifest['version'] and sum(step['size'] for step in patch_route) < manifest['size']:
+            route = patch_route
+
+    return {'version': manifest['version'], 'file': manifest['file'], 'hash': manifest['hash'], 'size': manifest['size'],
+            'route': route}
+
+
+def get_update_file_path(filename):
+    """Путь к файлу из манифеста (сборка или патч); чужие имена не отдаём."""
+    with update_manifest_lock:
+        manifest = update_manifest
+    if not manifest:
+        return None
+    if filename in {build['file'] for build in manifest['builds']}:
+        return os.path.join(UPDATE_FOLDER, filename)
+    if filename in {patch['file'] for patch in manifest['patches']}:
+        return os.path.join(UPDATE_PATCH_FOLDER, filename)
+    return None
+
+
+def find_request_end(data):
+    """Возвращает позицию сразу за первым JSON-объектом в data или None, если он ещё не пришёл целиком."""
+    depth = 0
+    in_string = False
+    escaped = False
+    for index, byte in enumerate(data):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif byte == ord('\\'):
+                escaped = True
+            elif byte == ord('"'):
+                in_string = False
+        elif byte == ord('"'):
+            in_string = True
+        elif byte == ord('{'):
+            depth += 1
+        elif byte == ord('}'):
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
 
 def handle_client(connection, address):
     """Обрабатывает запросы клиента."""
     logging.info(f'Подключен клиент: {address}')
+    # Байты, пришедшие после предыдущей команды (начало следующей), - обрабатываются раньше нового recv.
+    pending_data = b''
     try:
         while True:
             try:
-                data = connection.recv(BUFFER_SIZE)
+                if pending_data:
+                    data, pending_data = pending_data, b''
+                else:
+                    data = connection.recv(BUFFER_SIZE)
+                    if not data:
+                        break
+
+                data = data.lstrip()
                 if not data:
+                    continue
+                if not data.startswith(b'{'):
+                    # Дальше идут не команды, а чьи-то данные - разбирать их как команды нельзя.
+                    logging.error("Поток команд рассинхронизирован, соединение закрывается.")
                     break
 
+                request_end = find_request_end(data)
+                if request_end is None:
+                    # Команда пришла не целиком - дочитываем.
+                    if len(data) >= MAX_REQUEST_SIZE:
+                        logging.error("Слишком длинная команда, соединение закрывается.")
+                        break
+                    more_data = connection.recv(BUFFER_SIZE)
+                    if not more_data:
+                        break
+                    pending_data = data + more_data
+                    continue
+                pending_data = data[request_end:]
+
                 try:
-                    request = json.loads(data.decode("utf-8", errors="ignore"))
+                    request = json.loads(data[:request_end].decode("utf-8"))
+                    if not isinstance(request, dict):
+                        logging.warning(f"Некорректный запрос: ожидался объект, получено {type(request).__name__}.")
+                        continue
                     command = request.get('command')
                     folder = request.get('folder')
 
@@ -111,6 +344,23 @@ def handle_client(connection, address):
                             connection.sendall(b"0\n")  # Отправляем 0, если файл не найден
 
 
+                    elif command == 'get_update_manifest':
+                        manifest = get_update_route(request.get('version'))
+                        if manifest:
+                            connection.sendall(json.dumps(manifest).encode())
+                        else:
+                            connection.sendall(json.dumps({'error': 'Update manifest is not ready'}).encode())
+
+
+                    elif command == 'get_update_file':
+                        update_file_path = get_update_file_path(request.get('file'))
+                        if update_file_path and os.path.isfile(update_file_path):
+                            send_file(connection, update_file_path)
+                        else:
+                            logging.warning(f"Запрошен неизвестный файл обновления '{request.get('file')}'.")
+                            connection.sendall(b"0\n")
+
+
                     elif command in ('list_files', 'get_file', 'upload_file'):
                         target_folder = {'cards': CARD_FOLDER, 'mods': MOD_FOLDER}.get(folder)
 
@@ -123,7 +373,8 @@ def handle_client(connection, address):
                             files = {}
                             for filename in os.listdir(target_folder):
                                 file_path = os.path.join(target_folder, filename)
-                                if os.path.isfile(file_path):
+                                # *.tmp - недокачанные загрузки, их не показываем.
+                                if os.path.isfile(file_path) and not filename.endswith('.tmp'):
                                     file_info = get_file_info(file_path)
                                     if file_info:
                                         files[filename] = file_info
@@ -153,7 +404,7 @@ def handle_client(connection, address):
                             if filename and file_size > 0:
                                 file_path = os.path.join(target_folder, filename)
                                 try:
-                                    receive_file(connection, file_path, file_size, modified_time) # передаем время модификации
+                                    pending_data = receive_file(connection, file_path, file_size, modified_time, pending_data) # передаем время модификации
                                 except ConnectionResetError:
                                     logging.warning("Клиент разорвал соединение во время загрузки.")
 
@@ -166,7 +417,7 @@ def handle_client(connection, address):
 
 
 
-                except json.JSONDecodeError as error:
+                except (json.JSONDecodeError, UnicodeDecodeError) as error:
                     logging.error(f"Ошибка декодирования JSON: {error}")
 
 
@@ -182,12 +433,21 @@ def handle_client(connection, address):
         logging.info(f'Клиент отключен: {address}')
 
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-    server_socket.bind((HOST, PORT))
-    server_socket.listen()
-    logging.info(f'Сервер запущен на порту {PORT}')
+def run_server(host=HOST, port=PORT, serve_updates=True):
+    """Запускает сервер и обрабатывает каждого клиента в отдельном потоке."""
+    if serve_updates:
+        threading.Thread(target=prepare_updates, daemon=True).start()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((host, port))
+        server_socket.listen()
+        logging.info(f'Сервер запущен на порту {port}')
+
+        while True:
+            client_connection, client_address = server_socket.accept()
+            client_thread = threading.Thread(target=handle_client, args=(client_connection, client_address), daemon=True)
+            client_thread.start()
+
 
-    while True:
-        client_connection, client_address = server_socket.accept()
-        client_thread = threading.Thread(target=handle_client, args=(client_connection, client_address))
-        client_thread.start()
\ No newline at end of file
+if __name__ == '__main__':
+    run_server()